@@ -3,27 +3,194 @@
 import os
 import json
 import requests
+import net
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subprocess
 import tempfile
 import shutil
 import re
+import hashlib
+import atexit
+import threading
+import tarfile
+import io
+import mmap
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import pyzipper
+except ImportError:
+    pyzipper = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 GITHUB_API = "https://api.github.com"
-BACKUP_REPO = os.environ.get("BACKUP_REPO") or os.environ.get("GITHUB_REPOSITORY")
-GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
-ZIP_PASSWORD = os.environ.get("BACKUP_ZIP_PASSWORD")
+GRAPHQL_BATCH = 50
+COPY_BUFSIZE = 1 << 20
+ARCHIVE_MIMETYPES = {
+    ".7z": "application/x-7z-compressed",
+    ".zip": "application/zip",
+    ".tar.zst.enc": "application/octet-stream",
+}
+ARCHIVE_KINDS = {".7z": "7z", ".zip": "AES-256 zip", ".tar.zst.enc": "zstd tar (openssl aes-256-ctr, pbkdf2)"}
 TARGETS_FILE = Path("targets.json")
+PARALLELISM = int(os.environ.get("BACKUP_PARALLELISM") or "4")
+DOWNLOAD_WORKERS = int(os.environ.get("BACKUP_DOWNLOAD_WORKERS") or "8")
+API_RPS = float(os.environ.get("BACKUP_API_RPS") or "10")
+UPLOAD_RETRIES = int(os.environ.get("BACKUP_UPLOAD_RETRIES") or "3")
+CACHE_DIR = Path(
+    os.environ.get("BACKUP_CACHE_DIR")
+    or (Path(os.environ["RUNNER_TEMP"]) / "backup-cache" if os.environ.get("RUNNER_TEMP") else Path.home() / ".cache" / "backup_releases")
+)
+ETAG_CACHE_FILE = CACHE_DIR / "etag_cache.json"
+ARCHIVE_CACHE_DIR = CACHE_DIR / "archives"
+ASSET_CACHE_DIR = Path(os.environ["BACKUP_ASSET_CACHE"]) if os.environ.get("BACKUP_ASSET_CACHE") else None
+USE_TMPFS = os.environ.get("BACKUP_TMPFS", "1") != "0"
+TMPFS_DIR = "/dev/shm"
+TMPFS_HEADROOM = 512 << 20
+ARCHIVE_FORMAT = os.environ.get("BACKUP_ARCHIVE_FORMAT") or "7z"
+ZSTD_LEVEL = os.environ.get("BACKUP_ZSTD_LEVEL") or "3"
+SPOOL_MAX = int(os.environ.get("BACKUP_SPOOL_MAX") or str(64 << 20))
+SEVEN_ZIP_LEVEL = os.environ.get("BACKUP_7Z_LEVEL") or "1"
+SEVEN_ZIP_MMT = os.environ.get("BACKUP_7Z_MMT") or "on"
+
+ARCHIVE_ERRORS = (subprocess.CalledProcessError, OSError, RuntimeError, tarfile.TarError)
+PRECOMPRESSED_EXTS = {
+    ".7z", ".zip", ".gz", ".tgz", ".xz", ".txz", ".bz2", ".zst", ".lz", ".lz4", ".rar",
+    ".apk", ".aab", ".ipa", ".jar", ".whl", ".deb", ".rpm", ".dmg", ".msi", ".exe", ".appimage",
+    ".png", ".jpg", ".jpeg", ".webp", ".mp4", ".webm", ".mkv",
+}
+
+
+class RateLimiter:
+    def __init__(self, rps):
+        self.rps = rps
+        self.lock = threading.Lock()
+        self.tokens = rps
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.paused_until > now:
+                time.sleep(self.paused_until - now)
+                now = time.monotonic()
+            self.tokens = min(self.rps, self.tokens + (now - self.last) * self.rps)
+            self.last = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rps)
+                self.tokens = 0
+                self.last = time.monotonic()
+            else:
+                self.tokens -= 1
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def rate_limit_delay(r):
+    retry_after = r.headers.get("Retry-After")
+    if retry_after and r.status_code in (403, 429):
+        try:
+            return float(retry_after)
+        except ValueError:
+            return 60.0
+    if r.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(0.0, float(r.headers.get("X-RateLimit-Reset", "")) - time.time()) + 1
+        except ValueError:
+            return 60.0
+    return 0.0
+
+
+class RateLimitedSession(requests.Session):
+    def request(self, method, url, *args, **kwargs):
+        BUCKET.take()
+        r = super().request(method, url, *args, **kwargs)
+        delay = rate_limit_delay(r)
+        if delay:
+            log("rate-limit", f"GitHub rate limit hit; pausing requests for {delay:.0f}s")
+            BUCKET.pause(delay)
+            if method.upper() == "GET" and r.status_code in (403, 429):
+                r.close()
+                BUCKET.take()
+                r = super().request(method, url, *args, **kwargs)
+        return r
+
+
+BUCKET = RateLimiter(API_RPS)
+_OCTET_HEADERS = {"Accept": "application/octet-stream"}
+
+
+def make_session(token):
+    session = RateLimitedSession()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=max(32, PARALLELISM * DOWNLOAD_WORKERS),
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Authorization": f"Bearer {token}", "Accept": "application/vnd.github+json"})
+    return session
+
+
+@dataclass(frozen=True, slots=True)
+class BackupConfig:
+    session: requests.Session
+    backup_repo: str
+    zip_password: str
+
+
+_print_lock = threading.Lock()
+_etag_lock = threading.Lock()
+_etag_cache = {}
+_etag_loaded = False
+_backup_index_lock = threading.Lock()
+_scratch_lock = threading.Lock()
+_tmpfs_reserved = 0
+_backup_index = None
+
+_RE_NONWORD = re.compile(r"[^\w\.-]+")
+_RE_UNDERSCORES = re.compile(r"_{2,}")
+_RE_FINGERPRINT = re.compile(r"^- \*\*Fingerprint:\*\* `([0-9a-f]{64}|n/a)`", re.M)
+_RE_RELEASE_ID = re.compile(r"/releases/(\d+)/assets")
 
-if not GITHUB_TOKEN:
-    raise RuntimeError("GITHUB_TOKEN environment variable not set")
-if not ZIP_PASSWORD:
-    raise RuntimeError("BACKUP_ZIP_PASSWORD environment variable not set")
-if not TARGETS_FILE.exists():
-    raise RuntimeError(f"{TARGETS_FILE} not found in repo root")
 
-HEADERS = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
+def _load_config():
+    backup_repo = os.environ.get("BACKUP_REPO") or os.environ.get("GITHUB_REPOSITORY")
+    token = os.environ.get("GITHUB_TOKEN")
+    zip_password = os.environ.get("BACKUP_ZIP_PASSWORD")
+    if not token:
+        raise RuntimeError("GITHUB_TOKEN environment variable not set")
+    if not zip_password:
+        raise RuntimeError("BACKUP_ZIP_PASSWORD environment variable not set")
+    if not TARGETS_FILE.exists():
+        raise RuntimeError(f"{TARGETS_FILE} not found in repo root")
+    return BackupConfig(session=make_session(token), backup_repo=backup_repo, zip_password=zip_password)
+
+
+def log(label, msg):
+    with _print_lock:
+        print(f"[{label}] {msg}", flush=True)
 
 
 def parse_target(t):
@@ -60,76 +227,528 @@ def sanitize_for_tag(s: str, max_len: int = 80) -> str:
     if not s:
         return "unknown"
     s = str(s)
-    s = re.sub(r"[^\w\.-]+", "_", s)
-    s = re.sub(r"_{2,}", "_", s)
+    s = _RE_NONWORD.sub("_", s)
+    s = _RE_UNDERSCORES.sub("_", s)
     s = s.strip("._-")
     if len(s) > max_len:
         s = s[:max_len].rstrip("._-")
     return s or "unknown"
 
 
-def get_latest_release(owner, repo, allow_prerelease=False):
+def load_etag_cache():
+    global _etag_loaded
+    if _etag_loaded:
+        return
+    try:
+        data = json.loads(ETAG_CACHE_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        data = {}
+    with _etag_lock:
+        _etag_cache.clear()
+        _etag_cache.update(data)
+    _etag_loaded = True
+    atexit.register(save_etag_cache)
+
+
+def save_etag_cache():
+    with _etag_lock:
+        data = json.dumps(_etag_cache)
+    ETAG_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = ETAG_CACHE_FILE.with_suffix(".tmp")
+    tmp.write_text(data, encoding="utf-8")
+    tmp.replace(ETAG_CACHE_FILE)
+
+
+def _json(r):
+    return orjson.loads(r.content) if orjson else r.json()
+
+
+def post_json(cfg, url, payload):
+    if orjson:
+        return cfg.session.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"})
+    return cfg.session.post(url, json=payload)
+
+
+def iter_json_items(r):
+    if ijson is None:
+        return iter(_json(r))
+    r.raw.decode_content = True
+    return ijson.items(r.raw, "item", use_float=True)
+
+
+def cached_get(cfg, url, pick=None, cache_key=None):
+    key = cache_key or url
+    with _etag_lock:
+        entry = _etag_cache.get(key)
+    headers = {"If-None-Match": entry[0]} if entry else None
+    with cfg.session.get(url, headers=headers, stream=pick is not None) as r:
+        if r.status_code == 304 and entry:
+            return 200, entry[1], entry[2] if len(entry) > 2 else None
+        if r.status_code != 200:
+            return r.status_code, r.text, None
+        body = pick(iter_json_items(r)) if pick else _json(r)
+        etag = r.headers.get("ETag")
+        next_url = r.links.get("next", {}).get("url")
+    if etag:
+        with _etag_lock:
+            _etag_cache[key] = [etag, body, next_url]
+    return 200, body, next_url
+
+
+def get_latest_release(cfg, owner, repo, allow_prerelease=False):
     if not allow_prerelease:
         url = f"{GITHUB_API}/repos/{owner}/{repo}/releases/latest"
-        r = requests.get(url, headers=HEADERS)
-        if r.status_code == 200:
-            return r.json()
-    url = f"{GITHUB_API}/repos/{owner}/{repo}/releases"
-    r = requests.get(url, headers=HEADERS)
-    if r.status_code != 200:
-        print(f"Failed to list releases for {owner}/{repo}: {r.status_code} {r.text}")
+        status, body, _ = cached_get(cfg, url)
+        if status == 200:
+            return body
+        if status != 404:
+            log(f"{owner}/{repo}", f"Failed to fetch latest release: {status} {body}")
+            return None
+
+    def pick(releases):
+        for rel in releases:
+            if rel.get("draft"):
+                continue
+            if rel.get("prerelease") and not allow_prerelease:
+                continue
+            return rel
         return None
-    for rel in r.json():
-        if rel.get("draft"):
-            continue
-        if rel.get("prerelease") and not allow_prerelease:
+
+    url = f"{GITHUB_API}/repos/{owner}/{repo}/releases?per_page=10"
+    status, body, _ = cached_get(cfg, url, pick=pick, cache_key=f"{url}#prerelease={allow_prerelease}")
+    if status != 200:
+        log(f"{owner}/{repo}", f"Failed to list releases: {status} {body}")
+        return None
+    return body
+
+
+GRAPHQL_RELEASE_FIELDS = """
+    tagName name isDraft isPrerelease url description publishedAt createdAt
+    author { login name }
+    releaseAssets(first: 100) { pageInfo { hasNextPage } nodes { name size downloadUrl updatedAt } }
+"""
+
+
+def release_from_graphql(node):
+    return {
+        "tag_name": node.get("tagName"),
+        "name": node.get("name"),
+        "draft": node.get("isDraft"),
+        "prerelease": node.get("isPrerelease"),
+        "html_url": node.get("url"),
+        "body": node.get("description"),
+        "published_at": node.get("publishedAt"),
+        "created_at": node.get("createdAt"),
+        "author": node.get("author") or {},
+        "assets": [
+            {
+                "name": a.get("name"),
+                "size": a.get("size"),
+                "updated_at": a.get("updatedAt"),
+                "browser_download_url": a.get("downloadUrl"),
+            }
+            for a in (node.get("releaseAssets") or {}).get("nodes") or []
+        ],
+    }
+
+
+def fetch_latest_releases(cfg, targets):
+    parsed = []
+    for t in targets:
+        owner, repo, allow_prerelease = parse_target(t)
+        if owner and repo:
+            parsed.append((owner, repo, allow_prerelease))
+    found = {}
+    for start in range(0, len(parsed), GRAPHQL_BATCH):
+        batch = parsed[start:start + GRAPHQL_BATCH]
+        parts = []
+        for i, (owner, repo, allow_prerelease) in enumerate(batch):
+            if allow_prerelease:
+                sel = f"releases(first: 10, orderBy: {{field: CREATED_AT, direction: DESC}}) {{ nodes {{ {GRAPHQL_RELEASE_FIELDS} }} }}"
+            else:
+                sel = f"latestRelease {{ {GRAPHQL_RELEASE_FIELDS} }}"
+            parts.append(f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(repo)}) {{ {sel} }}")
+        try:
+            r = post_json(cfg, f"{GITHUB_API}/graphql", {"query": "query { " + " ".join(parts) + " }"})
+            if r.status_code != 200:
+                log("graphql", f"Batched release lookup failed: {r.status_code} {r.text}")
+                continue
+            data = _json(r).get("data") or {}
+        except (requests.RequestException, ValueError, AttributeError) as e:
+            log("graphql", f"Batched release lookup failed: {e}")
             continue
-        return rel
-    return None
+        for i, (owner, repo, allow_prerelease) in enumerate(batch):
+            node = data.get(f"r{i}")
+            if node is None:
+                continue
+            if allow_prerelease:
+                candidates = [n for n in (node.get("releases") or {}).get("nodes") or [] if n and not n.get("isDraft")]
+            else:
+                candidates = [node["latestRelease"]] if node.get("latestRelease") else []
+            if candidates and ((candidates[0].get("releaseAssets") or {}).get("pageInfo") or {}).get("hasNextPage"):
+                continue
+            found[(owner, repo)] = release_from_graphql(candidates[0]) if candidates else None
+    return found
+
+
+def release_fingerprint(release):
+    assets = release.get("assets") or []
+    if not assets:
+        return None
+    key = sorted([a.get("name") or "", a.get("size") or 0, a.get("updated_at") or ""] for a in assets)
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def parse_fingerprint(body):
+    metadata = (body or "").split("\n---\n", 1)[0]
+    m = _RE_FINGERPRINT.search(metadata)
+    return m.group(1) if m and m.group(1) != "n/a" else None
+
+
+def backup_summary(rel):
+    return {
+        "tag_name": rel.get("tag_name"),
+        "upload_url": rel.get("upload_url"),
+        "assets": [a.get("name") for a in rel.get("assets") or [] if a.get("state") == "uploaded"],
+        "fingerprint": parse_fingerprint(rel.get("body")),
+    }
+
+
+def backup_index(cfg):
+    global _backup_index
+    with _backup_index_lock:
+        if _backup_index is not None:
+            return _backup_index
+        releases = {}
+        fingerprints = {}
+        complete = True
+        url = f"{GITHUB_API}/repos/{cfg.backup_repo}/releases?per_page=100"
+        while url:
+            status, page, url = cached_get(cfg, url, pick=lambda items: [backup_summary(rel) for rel in items])
+            if status != 200:
+                log("backup", f"Failed to list releases in {cfg.backup_repo}: {status} {page}")
+                complete = False
+                break
+            for rel in page:
+                releases[rel["tag_name"]] = rel
+                if rel["fingerprint"] and rel["assets"]:
+                    fingerprints.setdefault(rel["fingerprint"], rel["tag_name"])
+        _backup_index = (releases, fingerprints, complete)
+        return _backup_index
 
 
-def release_exists_in_backup(tag_name):
-    url = f"{GITHUB_API}/repos/{BACKUP_REPO}/releases/tags/{tag_name}"
-    r = requests.get(url, headers=HEADERS)
-    return r.status_code == 200
+def release_exists_in_backup(cfg, tag_name):
+    releases, _, complete = backup_index(cfg)
+    if complete or tag_name in releases:
+        return releases.get(tag_name)
+    url = f"{GITHUB_API}/repos/{cfg.backup_repo}/releases/tags/{tag_name}"
+    r = cfg.session.get(url)
+    if r.status_code != 200:
+        return None
+    return backup_summary(_json(r))
+
+
+def backup_fingerprints(cfg):
+    return backup_index(cfg)[1]
+
+
+def remember_fingerprint(fingerprint, tag_name):
+    with _backup_index_lock:
+        if _backup_index is not None:
+            _backup_index[1].setdefault(fingerprint, tag_name)
+
+
+def asset_cache_path(asset, dl):
+    if ASSET_CACHE_DIR is None:
+        return None
+    key = hashlib.sha256(f"{dl}\n{asset.get('updated_at') or ''}".encode("utf-8")).hexdigest()
+    return ASSET_CACHE_DIR / key
+
+
+def remote_asset_size(cfg, asset, dl, headers):
+    if asset.get("size"):
+        return asset["size"]
+    try:
+        r = cfg.session.head(dl, headers=headers, allow_redirects=True)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+    try:
+        return int(r.headers.get("Content-Length", ""))
+    except ValueError:
+        return None
 
 
-def download_asset_to_dir(asset, dest_dir):
+def store_cached_asset(fh, start, cached: Path):
+    end = fh.tell()
+    fh.seek(start)
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cached.parent, prefix=cached.name, suffix=".tmp", delete=False) as tmp:
+            shutil.copyfileobj(fh, tmp, COPY_BUFSIZE)
+        os.replace(tmp.name, cached)
+    finally:
+        fh.seek(end)
+
+
+def download_asset(cfg, asset, fh, label):
     name = asset.get("name") or "unnamed"
     dl = asset.get("browser_download_url") or asset.get("url")
     if not dl:
-        print(f" - asset {name} has no download url; skipping")
+        log(label, f" - asset {name} has no download url; skipping")
+        return False
+    stream_headers = None if asset.get("browser_download_url") else _OCTET_HEADERS
+    cached = asset_cache_path(asset, dl)
+    if cached and cached.is_file() and cached.stat().st_size == remote_asset_size(cfg, asset, dl, stream_headers):
+        log(label, f" - {name} unchanged in asset cache; skipping download")
+        with open(cached, "rb") as src:
+            shutil.copyfileobj(src, fh, COPY_BUFSIZE)
+        return True
+    start = fh.tell()
+    try:
+        status, text = net.download(cfg.session, dl, fh, headers=stream_headers, chunk=COPY_BUFSIZE)
+    except net.RETRYABLE_ERRORS as e:
+        log(label, f" - failed to download {name}: {e}")
+        return False
+    if status not in (200, 206, 302, 307):
+        log(label, f" - failed to download {name}: {status} {text}")
+        return False
+    if cached:
+        try:
+            store_cached_asset(fh, start, cached)
+        except OSError as e:
+            log(label, f" - could not cache {name}: {e}")
+    return True
+
+
+def download_asset_to_dir(cfg, asset, dest_dir, label):
+    out_path = Path(dest_dir) / (asset.get("name") or "unnamed")
+    with open(out_path, "w+b") as fh:
+        ok = download_asset(cfg, asset, fh, label)
+    if not ok:
+        out_path.unlink(missing_ok=True)
         return None
-    out_path = Path(dest_dir) / name
-    stream_headers = HEADERS.copy()
-    if not asset.get("browser_download_url"):
-        stream_headers = {**stream_headers, "Accept": "application/octet-stream"}
-    with requests.get(dl, headers=stream_headers, stream=True) as r:
-        if r.status_code not in (200, 302, 307):
-            print(f" - failed to download {name}: {r.status_code} {r.text}")
-            return None
-        with open(out_path, "wb") as fh:
-            for chunk in r.iter_content(1024 * 32):
-                if chunk:
-                    fh.write(chunk)
     return out_path
 
 
-def create_7z_archive(files_dir: Path, archive_path: Path, password: str):
+def download_asset_to_spool(cfg, asset, label):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+    if not download_asset(cfg, asset, spool, label):
+        spool.close()
+        return None
+    spool.seek(0)
+    return asset.get("name") or "unnamed", spool
+
+
+def is_precompressed(path: Path) -> bool:
+    return path.suffix.lower() in PRECOMPRESSED_EXTS
+
+
+@lru_cache(maxsize=None)
+def seven_zip_binary():
     seven = shutil.which("7z") or shutil.which("7za") or shutil.which("7zr")
     if not seven:
         raise RuntimeError("7z not found on PATH. Install p7zip-full in your workflow.")
-    cmd = [
-        seven, "a", "-t7z", str(archive_path),
-        str(files_dir) + os.sep,
-        f"-p{password}", "-mhe=on", "-mx=9"
-    ]
-    print("Running 7z:", " ".join(cmd))
-    subprocess.check_call(cmd)
+    return seven
+
+
+def seven_zip_opts(password: str):
+    return [f"-p{password}", "-mhe=on", f"-mmt={SEVEN_ZIP_MMT}", "-mmtf=on", "-ms=off"]
+
+
+def add_notes_to_7z(archive_path: Path, password: str, label: str, notes: bytes):
+    cmd = [seven_zip_binary(), "a", "-t7z", str(archive_path), "-sirelease-notes.txt",
+           *seven_zip_opts(password), f"-mx={SEVEN_ZIP_LEVEL}"]
+    log(label, "Running 7z: " + " ".join(cmd))
+    subprocess.run(cmd, input=notes, check=True)
+
+
+def append_to_7z(files_dir: Path, files: list, archive_path: Path, password: str, label: str):
+    stored = [p for p in files if is_precompressed(Path(p))]
+    packed = [p for p in files if not is_precompressed(Path(p))]
+    list_path = archive_path.with_name(archive_path.name + ".lst")
+    for group, method in ((stored, "-mx=0"), (packed, f"-mx={SEVEN_ZIP_LEVEL}")):
+        if not group:
+            continue
+        list_path.write_text("\n".join(Path(p).relative_to(files_dir).as_posix() for p in group) + "\n", encoding="utf-8")
+        cmd = [
+            seven_zip_binary(), "a", "-t7z", str(archive_path.resolve()),
+            "-scsUTF-8", f"@{list_path.resolve()}",
+            *seven_zip_opts(password), method,
+        ]
+        log(label, "Running 7z: " + " ".join(cmd))
+        subprocess.check_call(cmd, cwd=files_dir)
+
+
+def download_pipelined(cfg, assets, assets_dir: Path, label: str, append, fetch=None):
+    if not assets:
+        return []
+    if fetch is None:
+        fetch = lambda a: download_asset_to_dir(cfg, a, assets_dir, label)
+    pending = queue.Queue()
+    errors = []
+
+    def archiver():
+        while True:
+            batch = [pending.get()]
+            while True:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            files = [p for p in batch if p is not None]
+            if files and not errors:
+                try:
+                    append(files)
+                except Exception as e:
+                    errors.append(e)
+            if None in batch:
+                return
+
+    worker = threading.Thread(target=archiver, name=f"archive-{label}")
+    worker.start()
+    downloaded = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_WORKERS, len(assets)))) as ex:
+            futures = [ex.submit(fetch, a) for a in assets]
+            for fut in as_completed(futures):
+                got = fut.result()
+                if got:
+                    downloaded.append(got)
+                    pending.put(got)
+    finally:
+        pending.put(None)
+        worker.join()
+    if errors:
+        raise errors[0]
+    return downloaded
+
+
+def download_into_7z(cfg, assets, assets_dir: Path, archive_path: Path, label: str, notes: bytes):
+    add_notes_to_7z(archive_path, cfg.zip_password, label, notes)
+    return download_pipelined(
+        cfg, assets, assets_dir, label,
+        lambda files: append_to_7z(assets_dir, files, archive_path, cfg.zip_password, label),
+    )
+
+
+def download_into_tar_zst(cfg, assets, assets_dir: Path, archive_path: Path, label: str, notes: bytes):
+    zstd = shutil.which("zstd")
+    openssl = shutil.which("openssl")
+    if not zstd or not openssl:
+        raise RuntimeError("zstd and openssl must be on PATH for BACKUP_ARCHIVE_FORMAT=tar.zst")
+    zstd_cmd = [zstd, "-q", f"-{ZSTD_LEVEL}", "-T0", "--long=27", "-c"]
+    enc_cmd = [openssl, "enc", "-aes-256-ctr", "-pbkdf2", "-salt", "-pass", "env:BACKUP_ZIP_PASSWORD"]
+    log(label, "Running " + " ".join(zstd_cmd) + " | " + " ".join(enc_cmd))
+    with open(archive_path, "wb") as out:
+        enc = subprocess.Popen(enc_cmd, stdin=subprocess.PIPE, stdout=out,
+                               env={**os.environ, "BACKUP_ZIP_PASSWORD": cfg.zip_password})
+    comp = subprocess.Popen(zstd_cmd, stdin=subprocess.PIPE, stdout=enc.stdin)
+    enc.stdin.close()
+    try:
+        with tarfile.open(fileobj=comp.stdin, mode="w|", format=tarfile.PAX_FORMAT,
+                          bufsize=COPY_BUFSIZE, copybufsize=COPY_BUFSIZE) as tar:
+            info = tarfile.TarInfo("release-notes.txt")
+            info.size = len(notes)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(notes))
+
+            def append(items):
+                for item in items:
+                    if isinstance(item, tuple):
+                        name, spool = item
+                        with spool:
+                            info = tarfile.TarInfo(name)
+                            info.size = spool.seek(0, os.SEEK_END)
+                            info.mode = 0o644
+                            info.mtime = int(time.time())
+                            spool.seek(0)
+                            tar.addfile(info, spool)
+                    else:
+                        tar.add(item, arcname=Path(item).name)
 
+            def fetch(a):
+                if (a.get("size") or 0) <= SPOOL_MAX:
+                    return download_asset_to_spool(cfg, a, label)
+                return download_asset_to_dir(cfg, a, assets_dir, label)
 
-def create_github_release_and_upload(tag_name, release_name, archive_path: Path, body_text: str, prerelease: bool = False):
-    url = f"{GITHUB_API}/repos/{BACKUP_REPO}/releases"
+            downloaded = download_pipelined(cfg, assets, assets_dir, label, append, fetch)
+    finally:
+        comp.stdin.close()
+        comp.wait()
+        enc.wait()
+    for proc, cmd in ((comp, zstd_cmd), (enc, enc_cmd)):
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return downloaded
+
+
+def archive_suffix(path: Path):
+    for suffix in ARCHIVE_MIMETYPES:
+        if path.name.endswith(suffix):
+            return suffix
+    return path.suffix
+
+
+def create_aes_zip(asset_path: Path, archive_path: Path, password: str, label: str, notes: bytes):
+    log(label, f"Writing AES-256 zip {archive_path.name}")
+    compression = pyzipper.ZIP_STORED if is_precompressed(asset_path) else pyzipper.ZIP_DEFLATED
+    with pyzipper.AESZipFile(archive_path, "w", compression=compression, encryption=pyzipper.WZ_AES) as zf:
+        zf.setpassword(password.encode("utf-8"))
+        zf.writestr("release-notes.txt", notes, compress_type=pyzipper.ZIP_DEFLATED)
+        zf.write(asset_path, asset_path.name)
+
+
+def archive_cache_key(fingerprint, backup_tag):
+    material = json.dumps([fingerprint, backup_tag, ARCHIVE_FORMAT, SEVEN_ZIP_LEVEL, ZSTD_LEVEL])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def find_cached_archive(key):
+    for suffix in ARCHIVE_MIMETYPES:
+        p = ARCHIVE_CACHE_DIR / f"{key}{suffix}"
+        if p.is_file():
+            return p
+    return None
+
+
+def link_or_copy(src: Path, dst: Path):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def store_cached_archive(key, archive_path: Path):
+    ARCHIVE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    dst = ARCHIVE_CACHE_DIR / f"{key}{archive_suffix(archive_path)}"
+    tmp = dst.with_name(dst.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    link_or_copy(archive_path, tmp)
+    tmp.replace(dst)
+
+
+@contextmanager
+def scratch_dir(needed: int, prefix: str = "bk_"):
+    global _tmpfs_reserved
+    root = None
+    if USE_TMPFS and os.path.isdir(TMPFS_DIR):
+        with _scratch_lock:
+            if shutil.disk_usage(TMPFS_DIR).free - _tmpfs_reserved >= needed + TMPFS_HEADROOM:
+                _tmpfs_reserved += needed
+                root = TMPFS_DIR
+    try:
+        with tempfile.TemporaryDirectory(prefix=prefix, dir=root) as tmp:
+            yield Path(tmp)
+    finally:
+        if root:
+            with _scratch_lock:
+                _tmpfs_reserved -= needed
+
+
+def create_github_release_and_upload(cfg, tag_name, release_name, archive_path: Path, body_text: str, label: str, prerelease: bool = False, asset_name: str = None):
+    url = f"{GITHUB_API}/repos/{cfg.backup_repo}/releases"
     payload = {
         "tag_name": tag_name,
         "name": release_name,
@@ -137,28 +756,129 @@ def create_github_release_and_upload(tag_name, release_name, archive_path: Path,
         "draft": False,
         "prerelease": prerelease
     }
-    r = requests.post(url, headers=HEADERS, json=payload)
+    r = post_json(cfg, url, payload)
     if r.status_code not in (200, 201):
-        print(f"Failed to create release {tag_name} in {BACKUP_REPO}: {r.status_code} {r.text}")
+        log(label, f"Failed to create release {tag_name} in {cfg.backup_repo}: {r.status_code} {r.text}")
         return False
-    upload_url = r.json().get("upload_url", "").split("{")[0]
+    created = _json(r)
+    return upload_release_asset(cfg, created.get("upload_url") or "", archive_path, label, asset_name)
+
+
+class FileChunks:
+    def __init__(self, fh, size, chunk_size=COPY_BUFSIZE):
+        self.fh = fh
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if not self.size:
+            return
+        with mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for off in range(0, self.size, self.chunk_size):
+                chunk = view[off:off + self.chunk_size]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+
+
+def fadvise(fh, advice):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fh.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def delete_partial_asset(cfg, upload_url, name, label):
+    m = _RE_RELEASE_ID.search(upload_url)
+    if not m:
+        return False
+    r = cfg.session.get(f"{GITHUB_API}/repos/{cfg.backup_repo}/releases/{m.group(1)}/assets", params={"per_page": 100})
+    if r.status_code != 200:
+        return False
+    for a in _json(r):
+        if a.get("name") != name:
+            continue
+        if a.get("state") == "uploaded":
+            return True
+        log(label, f"Deleting partial upload {name} (state {a.get('state')}).")
+        cfg.session.delete(a["url"])
+    return False
+
+
+def upload_release_asset(cfg, upload_url, archive_path: Path, label: str, name: str = None, clear_stale: bool = False):
+    upload_url = upload_url.split("{", 1)[0]
+    name = name or archive_path.name
     if not upload_url:
-        print("Upload URL missing from release creation response.")
+        log(label, "Upload URL missing from release creation response.")
         return False
-    mimetype = "application/x-7z-compressed"
-    with open(archive_path, "rb") as fh:
-        upload_r = requests.post(f"{upload_url}?name={archive_path.name}",
-                                 headers={**HEADERS, "Content-Type": mimetype}, data=fh)
-    if upload_r.status_code not in (200, 201):
-        print(f"Failed to upload {archive_path.name}: {upload_r.status_code} {upload_r.text}")
+    mimetype = ARCHIVE_MIMETYPES.get(archive_suffix(Path(name)), "application/octet-stream")
+    size = archive_path.stat().st_size
+    headers = {"Content-Type": mimetype, "Content-Length": str(size)}
+    if clear_stale and delete_partial_asset(cfg, upload_url, name, label):
+        log(label, f"{name} is already uploaded.")
+        return True
+    for attempt in range(UPLOAD_RETRIES + 1):
+        if attempt:
+            time.sleep(2 ** attempt)
+            if delete_partial_asset(cfg, upload_url, name, label):
+                log(label, f"{name} finished uploading before the connection dropped.")
+                return True
+            log(label, f"Retrying upload of {name} (attempt {attempt + 1}/{UPLOAD_RETRIES + 1}).")
+        try:
+            with open(archive_path, "rb") as fh:
+                fadvise(fh, "POSIX_FADV_SEQUENTIAL")
+                upload_r = cfg.session.post(f"{upload_url}?name={name}",
+                                            headers=headers, data=FileChunks(fh, size), timeout=(30, None))
+                fadvise(fh, "POSIX_FADV_DONTNEED")
+        except net.RETRYABLE_ERRORS as e:
+            log(label, f"Upload of {name} interrupted: {e}")
+            continue
+        if upload_r.status_code in (200, 201):
+            return True
+        if upload_r.status_code == 422 and "already_exists" in upload_r.text:
+            log(label, f"{name} already exists from an earlier attempt.")
+            continue
+        if upload_r.status_code < 500:
+            break
+        log(label, f"Upload of {name} failed with {upload_r.status_code}.")
+    else:
+        if delete_partial_asset(cfg, upload_url, name, label):
+            log(label, f"{name} finished uploading before the connection dropped.")
+            return True
+        log(label, f"Giving up on {name} after {UPLOAD_RETRIES + 1} attempts.")
         return False
-    return True
+    log(label, f"Failed to upload {name}: {upload_r.status_code} {upload_r.text}")
+    return False
+
+
+def release_author(release: dict) -> str:
+    author = release.get("author") or {}
+    return author.get("login") or author.get("name") or ""
+
+
+def release_notes(owner: str, repo: str, raw_tag: str, release: dict) -> bytes:
+    header = (
+        f"Source: {owner}/{repo}\n"
+        f"Original tag: {raw_tag}\n"
+        f"Original name: {release.get('name') or ''}\n"
+        f"Author: {release_author(release)}\n"
+        f"Original URL: {release.get('html_url') or ''}\n"
+        f"Published at: {release.get('published_at') or ''}\n"
+        f"Prerelease: {bool(release.get('prerelease', False))}\n"
+        f"\n---\n\n"
+    )
+    return (header + (release.get("body") or "")).encode("utf-8")
 
 
-def build_release_body(owner: str, repo: str, release: dict, downloaded_assets: list):
+def build_release_body(owner: str, repo: str, release: dict, downloaded_assets: list, fingerprint: str = None):
     raw_tag = release.get("tag_name") or release.get("name") or "unknown"
     simple_tag = normalize_tag(raw_tag)
-    author_login = (release.get("author") or {}).get("login") or (release.get("author") or {}).get("name") or "unknown"
+    author_login = release_author(release) or "unknown"
     published_at = release.get("published_at") or release.get("created_at") or ""
     published_at_disp = published_at or ""
     if published_at_disp:
@@ -174,6 +894,7 @@ def build_release_body(owner: str, repo: str, release: dict, downloaded_assets:
         assets_md += f"- `{name}` ({size} bytes) — {url}\n"
     if not assets_md:
         assets_md = "- (no assets in original release)\n"
+    archive_kind = ARCHIVE_KINDS.get(archive_suffix(Path(downloaded_assets[0])), "7z") if downloaded_assets else "7z"
     original_url = release.get("html_url") or f"https://github.com/{owner}/{repo}/releases/tag/{raw_tag}"
     body = (
         f"**Backup metadata**\n\n"
@@ -183,81 +904,147 @@ def build_release_body(owner: str, repo: str, release: dict, downloaded_assets:
         f"- **Original release URL:** {original_url}\n"
         f"- **Author:** `{author_login}`\n"
         f"- **Published at:** {published_at_disp}\n"
-        f"- **Prerelease:** {bool(release.get('prerelease', False))}\n\n"
+        f"- **Prerelease:** {bool(release.get('prerelease', False))}\n"
+        f"- **Fingerprint:** `{fingerprint or 'n/a'}`\n\n"
         f"**Assets included in this backup (originally):**\n\n"
         f"{assets_md}\n"
         f"---\n\n"
         f"**Original release notes:**\n\n"
         f"{release.get('body') or '(none)'}\n\n"
         f"---\n\n"
-        f"_This release contains an encrypted 7z archive of the original release assets and release notes. "
+        f"_This release contains an encrypted {archive_kind} archive of the original release assets and release notes. "
         f"Archive filename: `{Path(downloaded_assets[0]).name if downloaded_assets else 'archive.7z'}`_\n"
     )
     return body
 
 
+def process_target(cfg, t, prefetched=None):
+    owner, repo_name, allow_prerelease = parse_target(t)
+    if not owner or not repo_name:
+        log("targets", "Skipping invalid target entry.")
+        return "invalid"
+    label = f"{owner}/{repo_name}"
+    log(label, f"Checking latest release (allow_prerelease={allow_prerelease})...")
+    if prefetched is not None and (owner, repo_name) in prefetched:
+        release = prefetched[(owner, repo_name)]
+    else:
+        release = get_latest_release(cfg, owner, repo_name, allow_prerelease)
+    if not release:
+        log(label, "No release found.")
+        return "no-release"
+    raw_tag = release.get("tag_name") or release.get("name") or "unknown"
+    simple_tag = normalize_tag(raw_tag)
+    author_login = release_author(release) or "unknown"
+    owner_s = sanitize_for_tag(owner)
+    repo_s = sanitize_for_tag(repo_name)
+    ver_s = sanitize_for_tag(simple_tag)
+    author_s = sanitize_for_tag(author_login)
+    backup_tag = f"{owner_s}_{repo_s}-v{ver_s}-by-{author_s}"
+    if len(backup_tag) > 100:
+        backup_tag = backup_tag[:100].rstrip("._-")
+    fingerprint = release_fingerprint(release)
+    existing = release_exists_in_backup(cfg, backup_tag)
+    if existing and existing.get("assets"):
+        previous_fp = existing.get("fingerprint")
+        if fingerprint and previous_fp and previous_fp != fingerprint:
+            log(label, f"Assets of {raw_tag} changed upstream since backup {backup_tag} was made.")
+        log(label, f"Release {backup_tag} already backed up — skipping.")
+        return "exists"
+    if existing:
+        log(label, f"Release {backup_tag} exists without an archive -> completing it ...")
+    else:
+        previous_tag = backup_fingerprints(cfg).get(fingerprint) if fingerprint else None
+        if previous_tag:
+            log(label, f"Assets of {raw_tag} are unchanged since backup {previous_tag} — skipping.")
+            return "unchanged"
+        log(label, f"Found new release {raw_tag} -> creating backup {backup_tag} ...")
+    cache_key = archive_cache_key(fingerprint, backup_tag) if fingerprint else None
+    cached = find_cached_archive(cache_key) if cache_key else None
+    if cached:
+        log(label, f"Reusing cached archive for {backup_tag}")
+        return finish_backup(cfg, owner, repo_name, release, backup_tag, cached, fingerprint, existing, cache_key, label)
+    needed = 2 * sum(a.get("size") or 0 for a in release.get("assets", []))
+    with scratch_dir(needed, prefix=f"bk_{backup_tag}_") as tmp_path:
+        assets_dir = tmp_path / "assets"
+        assets_dir.mkdir()
+        assets = release.get("assets", [])
+        notes = release_notes(owner, repo_name, raw_tag, release)
+        zip_candidate = ARCHIVE_FORMAT == "7z" and pyzipper is not None and len(assets) == 1 and (assets[0].get("size") or 0) > 0
+        single = download_asset_to_dir(cfg, assets[0], assets_dir, label) if zip_candidate else None
+        if single:
+            archive_path = tmp_path / f"{backup_tag}.zip"
+            try:
+                create_aes_zip(single, archive_path, cfg.zip_password, label, notes)
+            except ARCHIVE_ERRORS as e:
+                log(label, f"AES zip failed: {e}")
+                return "failed"
+        elif ARCHIVE_FORMAT == "tar.zst":
+            archive_path = tmp_path / f"{backup_tag}.tar.zst.enc"
+            try:
+                download_into_tar_zst(cfg, assets, assets_dir, archive_path, label, notes)
+            except ARCHIVE_ERRORS as e:
+                log(label, f"tar | zstd | openssl failed: {e}")
+                return "failed"
+        else:
+            archive_path = tmp_path / f"{backup_tag}.7z"
+            try:
+                download_into_7z(cfg, [] if zip_candidate else assets, assets_dir, archive_path, label, notes)
+            except ARCHIVE_ERRORS as e:
+                log(label, f"7z failed: {e}")
+                return "failed"
+        return finish_backup(cfg, owner, repo_name, release, backup_tag, archive_path, fingerprint, existing, cache_key, label)
+
+
+def run_target(cfg, t, prefetched=None):
+    try:
+        return process_target(cfg, t, prefetched)
+    except Exception as e:
+        log("targets", f"Target {t!r} failed: {e!r}")
+        return "failed"
+
+
+def finish_backup(cfg, owner, repo_name, release, backup_tag, archive_path, fingerprint, existing, cache_key, label):
+    raw_tag = release.get("tag_name") or release.get("name") or "unknown"
+    asset_name = f"{backup_tag}{archive_suffix(archive_path)}"
+    if existing:
+        ok = upload_release_asset(cfg, existing.get("upload_url", ""), archive_path, label, asset_name, clear_stale=True)
+    else:
+        release_body = build_release_body(owner, repo_name, release, [asset_name], fingerprint)
+        ok = create_github_release_and_upload(cfg, backup_tag, backup_tag, archive_path, release_body, label,
+                                              prerelease=False, asset_name=asset_name)
+    if not ok:
+        log(label, f"Failed to upload backup ({raw_tag}).")
+        if cache_key and archive_path.parent != ARCHIVE_CACHE_DIR:
+            try:
+                store_cached_archive(cache_key, archive_path)
+            except OSError as e:
+                log(label, f"Could not cache archive for {backup_tag}: {e}")
+        return "failed"
+    if fingerprint:
+        remember_fingerprint(fingerprint, backup_tag)
+    if cache_key:
+        for suffix in ARCHIVE_MIMETYPES:
+            (ARCHIVE_CACHE_DIR / f"{cache_key}{suffix}").unlink(missing_ok=True)
+    log(label, f"Backup ({raw_tag}) completed and uploaded as {asset_name}")
+    return "done"
+
+
 def main():
+    global _backup_index
+    cfg = _load_config()
     with open(TARGETS_FILE, "r", encoding="utf-8") as f:
         targets = json.load(f)
-    for t in targets:
-        owner, repo_name, allow_prerelease = parse_target(t)
-        if not owner or not repo_name:
-            print("Skipping invalid target entry.")
-            continue
-        print(f"Checking latest release for {owner}/{repo_name} (allow_prerelease={allow_prerelease})...")
-        release = get_latest_release(owner, repo_name, allow_prerelease)
-        if not release:
-            print(f"No release found for {owner}/{repo_name}.\n")
-            continue
-        raw_tag = release.get("tag_name") or release.get("name") or "unknown"
-        simple_tag = normalize_tag(raw_tag)
-        author_login = (release.get("author") or {}).get("login") or (release.get("author") or {}).get("name") or "unknown"
-        owner_s = sanitize_for_tag(owner)
-        repo_s = sanitize_for_tag(repo_name)
-        ver_s = sanitize_for_tag(simple_tag)
-        author_s = sanitize_for_tag(author_login)
-        backup_tag = f"{owner_s}_{repo_s}-v{ver_s}-by-{author_s}"
-        if len(backup_tag) > 100:
-            backup_tag = backup_tag[:100].rstrip("._-")
-        release_name = backup_tag
-        if release_exists_in_backup(backup_tag):
-            print(f"Release {backup_tag} already backed up — skipping.\n")
-            continue
-        print(f"Found new release {raw_tag} -> creating backup {backup_tag} ...")
-        with tempfile.TemporaryDirectory() as tmp:
-            tmp_path = Path(tmp)
-            downloaded = []
-            for a in release.get("assets", []):
-                got = download_asset_to_dir(a, tmp_path)
-                if got:
-                    downloaded.append(got)
-            notes_file = tmp_path / "release-notes.txt"
-            notes_header = (
-                f"Source: {owner}/{repo_name}\n"
-                f"Original tag: {raw_tag}\n"
-                f"Original name: {release.get('name') or ''}\n"
-                f"Author: {(release.get('author') or {}).get('login') or (release.get('author') or {}).get('name') or ''}\n"
-                f"Original URL: {release.get('html_url') or ''}\n"
-                f"Published at: {release.get('published_at') or ''}\n"
-                f"Prerelease: {bool(release.get('prerelease', False))}\n"
-                f"\n---\n\n"
-            )
-            notes_body = release.get("body") or ""
-            notes_file.write_text(notes_header + notes_body, encoding="utf-8")
-            downloaded.insert(0, notes_file)
-            archive_path = tmp_path / f"{backup_tag}.7z"
-            try:
-                create_7z_archive(tmp_path, archive_path, ZIP_PASSWORD)
-            except subprocess.CalledProcessError as e:
-                print("7z failed:", e)
-                continue
-            release_body = build_release_body(owner, repo_name, release, [archive_path])
-            ok = create_github_release_and_upload(backup_tag, release_name, archive_path, release_body, prerelease=False)
-            if ok:
-                print(f"Backup for {owner}/{repo_name} ({raw_tag}) completed and uploaded as {archive_path.name}\n")
-            else:
-                print(f"Failed to upload backup for {owner}/{repo_name} ({raw_tag}).\n")
-    print("All targets processed.")
+    _backup_index = None
+    load_etag_cache()
+    try:
+        prefetched = fetch_latest_releases(cfg, targets)
+        with ThreadPoolExecutor(max_workers=max(1, min(PARALLELISM, len(targets)))) as ex:
+            statuses = list(ex.map(lambda t: run_target(cfg, t, prefetched), targets))
+    finally:
+        save_etag_cache()
+    done = statuses.count("done")
+    failed = statuses.count("failed")
+    print(f"All targets processed ({done} backed up, {failed} failed).")
 
 
 if __name__ == "__main__":
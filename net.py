@@ -0,0 +1,34 @@
+import shutil
+import time
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    ProtocolError,
+    ReadTimeoutError,
+)
+
+
+def download(session, url, fh, headers=None, chunk=1 << 20, retries=3):
+    start = fh.tell()
+    for attempt in range(retries + 1):
+        req_headers = {**(headers or {}), "Accept-Encoding": "identity"}
+        written = fh.tell() - start
+        if written:
+            req_headers["Range"] = f"bytes={written}-"
+        try:
+            with session.get(url, headers=req_headers, stream=True) as r:
+                if r.status_code not in (200, 206):
+                    return r.status_code, r.text
+                if r.status_code == 200 and written:
+                    fh.seek(start)
+                    fh.truncate()
+                shutil.copyfileobj(r.raw, fh, length=chunk)
+                return r.status_code, ""
+        except RETRYABLE_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)